@@ -4,40 +4,290 @@ import argparse
 import aiohttp
 import asyncio
 import os
-import json
-from typing import List, Dict, Set
+from typing import List, Dict, Optional, Set, Tuple
 import logging
 from urllib.parse import urlparse
 import sys
 import aiofiles
+import aiofiles.os
+import orjson
 import time
 from asyncio import Semaphore
+import random
 import re
+import sqlite3
+import threading
 import urllib.parse
 from pathlib import Path
 
+try:
+    import uvloop  # faster event loop, not available on Windows
+except ImportError:
+    uvloop = None
+
+_RE_NONWORD = re.compile(r'[^\w\s-]')
+_RE_SPACES = re.compile(r'[-\s]+')
+_RE_CD_FILENAME = re.compile(r'filename=(.+)')
+
+class LookupInconclusive(Exception):
+    """A PDF source failed to answer, so it is unknown whether it has the paper"""
+
+class TokenBucket:
+    """Async token bucket allowing `rate` requests per second with bursts up to `capacity`"""
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a token is available and take it"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
 class PaperFetcher:
-    def __init__(self, output_dir: str, api_key: str = None):
+    def __init__(self, output_dir: str, api_key: str = None, max_children: int = 50):
         self.base_url = "https://api.semanticscholar.org/graph/v1/paper/"
         self.headers = {"x-api-key": api_key} if api_key else {}
         self.output_dir = output_dir
         self.visited_papers: Set[str] = set()
+        self._scheduled: Set[str] = set()  # papers already queued for processing
+        self.max_children = max_children  # connected papers followed per paper
         self.logger = logging.getLogger('paper_fetcher')
         self.rate_limit = Semaphore(3)  # number of concurrent requests
-        self.request_interval = 2.0  # time between requests in seconds
-        self.last_request_time = 0
+        # ids per Semantic Scholar batch request, the endpoint allows 500 but caps the citations
+        # and references it returns per call, so requesting them needs smaller batches
+        self.batch_size = 100
+        # only the sub-fields we use, citations/references can otherwise be huge
+        self.paper_fields = 'title,year,authors.name,citations.paperId,citations.year,references.paperId,references.year,externalIds,url,openAccessPdf'
+        self.num_metadata_workers = 3  # workers fetching metadata
+        self.num_workers = 16  # workers downloading PDFs
+        self.chunk_size = 64 * 1024  # bytes written per chunk when streaming PDFs
+        self.max_pdf_size = 200 * 1024 * 1024  # skip PDFs larger than this
+        self.pdf_content_types = {'application/pdf', 'application/x-pdf', 'application/octet-stream'}
+        self._verified_pdf_urls: Set[str] = set()  # URLs that already passed probe_pdf
+        self.probe_timeout = aiohttp.ClientTimeout(total=10)  # per request, for PDF probes
+        self.not_found_statuses = {404, 410}  # statuses that definitely mean a source has no PDF
+        # requests per second allowed for each host, anything else uses default_host_rate
+        self.host_rates = {
+            'api.semanticscholar.org': 1.0,
+            'arxiv.org': 10.0,
+            'api.unpaywall.org': 10.0,
+            'api.core.ac.uk': 5.0,
+        }
+        self.default_host_rate = 5.0
+        self._host_buckets: Dict[str, TokenBucket] = {}
+        self.max_retries = 3
+        self.retry_base_delay = 2.0  # seconds, doubled on every retry
+        self.retry_statuses = {429, 500, 502, 503, 504}
+        self._session: aiohttp.ClientSession = None
+        self.cache_max_age = 7 * 24 * 3600  # seconds before cached metadata is refetched
+        self._cache: sqlite3.Connection = None
+        self._cache_lock = threading.Lock()  # cache queries run in worker threads
+        self.metadata_file = os.path.join(output_dir, 'papers_metadata.json')
+        self._metadata_lock = asyncio.Lock()
+        self.metadata_save_interval = 10.0  # seconds between rewrites of papers_metadata.json during a run
+        self._metadata_saved_at = 0.0
+        # papers with no PDF to be found, kept across runs so a resumed run doesn't look again
+        self.visited_file = os.path.join(output_dir, '.visited.json')
+        self.previously_visited: Dict[str, float] = self.load_visited()
+        self._no_pdf_found: Dict[str, float] = {}
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared HTTP session, creating it on first use"""
+        # one session for the whole run keeps connections (and TLS) warm across hosts
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=64, limit_per_host=8, ttl_dns_cache=600, keepalive_timeout=30,
+                                             enable_cleanup_closed=True, force_close=False)
+            # cookies are never needed and shouldn't leak between the hosts we scrape
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60),
+                                                  cookie_jar=aiohttp.DummyCookieJar(),
+                                                  json_serialize=lambda obj: orjson.dumps(obj).decode())
+        return self._session
+
+    async def aclose(self):
+        """Close the shared HTTP session and the cache"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self._cache is not None:
+            await asyncio.to_thread(self._with_cache, lambda cache: cache.close())
+            self._cache = None
+
+    def _get_cache(self) -> sqlite3.Connection:
+        """Return the on-disk cache of paper metadata and downloaded PDFs, creating it on first use"""
+        if self._cache is None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            self._cache = sqlite3.connect(os.path.join(self.output_dir, '.cache.sqlite'), check_same_thread=False)
+            self._cache.execute("CREATE TABLE IF NOT EXISTS papers (paper_id TEXT PRIMARY KEY, json TEXT, fetched_at REAL)")
+            self._cache.execute("CREATE TABLE IF NOT EXISTS pdfs (paper_id TEXT PRIMARY KEY, filepath TEXT)")
+            self._cache.commit()
+        return self._cache
+
+    def _with_cache(self, query):
+        """Run `query` against the cache connection, one thread at a time"""
+        with self._cache_lock:
+            return query(self._get_cache())
+
+    async def get_cached_papers(self, paper_ids: List[str]) -> Dict[str, Dict]:
+        """Return cached metadata, keyed by paper id, for the papers that are recent enough"""
+        def query(cache):
+            cutoff = time.time() - self.cache_max_age
+            found = {}
+            for i in range(0, len(paper_ids), self.batch_size):
+                chunk = paper_ids[i:i + self.batch_size]
+                placeholders = ','.join('?' * len(chunk))
+                rows = cache.execute(
+                    f"SELECT paper_id, json FROM papers WHERE fetched_at > ? AND paper_id IN ({placeholders})",
+                    (cutoff, *chunk))
+                found.update((paper_id, orjson.loads(data)) for paper_id, data in rows)
+            return found
+        return await asyncio.to_thread(self._with_cache, query)
+
+    async def get_cached_paper(self, paper_id: str) -> Dict:
+        """Return cached metadata for a paper if it is recent enough"""
+        return (await self.get_cached_papers([paper_id])).get(paper_id)
+
+    async def cache_papers(self, papers: Dict[str, Dict]):
+        """Store metadata for many papers, keyed by paper id, in a single transaction"""
+        def query(cache):
+            now = time.time()
+            cache.executemany("INSERT OR REPLACE INTO papers (paper_id, json, fetched_at) VALUES (?, ?, ?)",
+                              [(paper_id, orjson.dumps(paper_data), now) for paper_id, paper_data in papers.items()])
+            cache.commit()
+        await asyncio.to_thread(self._with_cache, query)
+
+    async def get_cached_pdf(self, paper_id: str) -> str:
+        """Return the path of a previously downloaded PDF if it is still on disk"""
+        def query(cache):
+            row = cache.execute("SELECT filepath FROM pdfs WHERE paper_id = ?", (paper_id,)).fetchone()
+            if row and os.path.exists(row[0]):
+                return row[0]
+            return None
+        return await asyncio.to_thread(self._with_cache, query)
+
+    async def cache_pdf(self, paper_id: str, filepath: str):
+        """Record a downloaded PDF in the cache"""
+        def query(cache):
+            cache.execute("INSERT OR REPLACE INTO pdfs (paper_id, filepath) VALUES (?, ?)", (paper_id, filepath))
+            cache.commit()
+        await asyncio.to_thread(self._with_cache, query)
+
+    def load_visited(self) -> Dict[str, float]:
+        """Load the papers previous runs found no PDF for, with when they were checked"""
+        try:
+            with open(self.visited_file, 'rb') as f:
+                visited = orjson.loads(f.read())
+        except FileNotFoundError:
+            return {}
+        except orjson.JSONDecodeError as e:
+            self.logger.warning(f"Ignoring unreadable {self.visited_file}: {str(e)}")
+            return {}
+        if not isinstance(visited, dict):
+            # older files hold a plain list without timestamps, so check those papers again
+            return {}
+        # sources gain open access copies over time, so entries expire like cached metadata
+        cutoff = time.time() - self.cache_max_age
+        return {paper_id: checked_at for paper_id, checked_at in visited.items() if checked_at > cutoff}
+
+    async def save_visited(self):
+        """Persist the papers this and previous runs found no PDF for"""
+        visited = {**self.previously_visited, **self._no_pdf_found}
+        await aiofiles.os.makedirs(self.output_dir, exist_ok=True)
+        async with aiofiles.open(self.visited_file, 'wb') as f:
+            await f.write(orjson.dumps(visited, option=orjson.OPT_SORT_KEYS))
+
+    async def save_metadata(self, results: List[Dict], force: bool = True):
+        """Write the metadata of all downloaded papers so far
+
+        Unless `force` is set, the write is skipped if the file was saved less than
+        `metadata_save_interval` seconds ago, so saving after every download stays cheap.
+        """
+        if not force and time.monotonic() - self._metadata_saved_at < self.metadata_save_interval:
+            return
+        # write to a temporary file first so an interrupted run never leaves a truncated file
+        tmp_file = f"{self.metadata_file}.tmp"
+        async with self._metadata_lock:
+            self._metadata_saved_at = time.monotonic()
+            await aiofiles.os.makedirs(self.output_dir, exist_ok=True)
+            # serialize a snapshot in a thread, other workers keep appending to results meanwhile
+            data = await asyncio.to_thread(orjson.dumps, list(results), option=orjson.OPT_INDENT_2)
+            async with aiofiles.open(tmp_file, 'wb') as f:
+                await f.write(data)
+            await aiofiles.os.replace(tmp_file, self.metadata_file)
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """The shared HTTP session, open while inside `async with PaperFetcher(...)`"""
+        return self._session
+
+    async def __aenter__(self):
+        await self._get_session()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.aclose()
+
+    async def wait_for_rate_limit(self, url: str):
+        """Ensure we don't exceed the rate limit of the host serving `url`"""
+        host = urlparse(url).hostname or ''
+        bucket = self._host_buckets.get(host)
+        if bucket is None:
+            bucket = TokenBucket(self.host_rates.get(host, self.default_host_rate))
+            self._host_buckets[host] = bucket
+        await bucket.acquire()
 
-    async def wait_for_rate_limit(self):
-        """Ensure we don't exceed API rate limits"""
-        now = time.time()
-        if now - self.last_request_time < self.request_interval:
-            await asyncio.sleep(self.request_interval - (now - self.last_request_time))
-        self.last_request_time = time.time()
+    def _retry_delay(self, attempt: int, retry_after: str = None) -> float:
+        """Seconds to wait before the next attempt, preferring the server's Retry-After hint"""
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = self.retry_base_delay * 2 ** attempt
+        # jitter so concurrent requests don't all retry at the same moment
+        return delay + random.uniform(0, 0.5)
+
+    async def _request_with_retries(self, session: aiohttp.ClientSession, method: str, url: str,
+                                    **kwargs) -> aiohttp.ClientResponse:
+        """Send a rate limited request, retrying rate limits, server errors and connection errors
+
+        The caller is responsible for releasing the returned response.
+        """
+        for attempt in range(self.max_retries):
+            await self.wait_for_rate_limit(url)
+            last_attempt = attempt == self.max_retries - 1
+            try:
+                response = await session.request(method, url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if last_attempt:
+                    raise
+                wait_time = self._retry_delay(attempt)
+                self.logger.warning(f"Connection error for {url} ({e!r}), retrying in {wait_time:.1f} seconds...")
+                await asyncio.sleep(wait_time)
+                continue
+
+            if response.status in self.retry_statuses and not last_attempt:
+                wait_time = self._retry_delay(attempt, response.headers.get('Retry-After'))
+                response.release()
+                if response.status == 429:
+                    self.logger.warning(f"Rate limit hit, waiting {wait_time:.1f} seconds...")
+                else:
+                    self.logger.warning(f"Server error {response.status} for {url}, retrying in {wait_time:.1f} seconds...")
+                await asyncio.sleep(wait_time)
+                continue
+            return response
 
     def clean_filename(self, title: str) -> str:
         """Convert title to a clean filename"""
-        clean = re.sub(r'[^\w\s-]', '', title)
-        clean = re.sub(r'[-\s]+', '_', clean)
+        clean = _RE_NONWORD.sub('', title)
+        clean = _RE_SPACES.sub('_', clean)
         return clean[:100]
 
     def extract_filename_from_response(self, response: aiohttp.ClientResponse, paper_data: Dict) -> str:
@@ -45,9 +295,9 @@ class PaperFetcher:
         # try to get filename
         cd = response.headers.get('Content-Disposition')
         if cd:
-            fname = re.findall("filename=(.+)", cd)
+            fname = _RE_CD_FILENAME.search(cd)
             if fname:
-                filename = fname[0].strip('"')
+                filename = fname.group(1).strip('"')
                 self.logger.info(f"Using filename from Content-Disposition: {filename}")
                 return filename
 
@@ -70,48 +320,144 @@ class PaperFetcher:
         self.logger.info(f"Using fallback filename: {fallback}")
         return fallback
 
-    async def try_alternative_sources(self, paper_data: Dict, session: aiohttp.ClientSession) -> str:
-        """Try to find PDF from alternative sources"""
+    def _response_ok(self, response: aiohttp.ClientResponse, description: str, log_level: int = logging.ERROR) -> bool:
+        """Check for a 2xx status, logging and releasing the connection straight away otherwise"""
+        if 200 <= response.status < 300:
+            return True
+        self.logger.log(log_level, f"{description} failed with status {response.status}")
+        response.release()
+        return False
+
+    def is_pdf_response(self, response: aiohttp.ClientResponse) -> bool:
+        """Check whether a response's Content-Type allows it to be a PDF"""
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+        return not content_type or content_type in self.pdf_content_types
+
+    async def probe_pdf(self, pdf_url: str, session: aiohttp.ClientSession) -> Optional[bool]:
+        """Cheaply check that a URL serves a PDF before downloading it
+
+        Returns None when the server's answer doesn't tell either way.
+        """
+        if pdf_url in self._verified_pdf_urls:
+            return True
+        result = await self._probe_pdf(pdf_url, session)
+        if result:
+            self._verified_pdf_urls.add(pdf_url)
+        return result
+
+    async def _probe_pdf(self, pdf_url: str, session: aiohttp.ClientSession) -> Optional[bool]:
+        """Probe a URL with HEAD, falling back to a ranged GET"""
+        # a single short HEAD without retries, on errors or timeouts go straight to the ranged GET below
         try:
-            # arXiv
-            arxiv_id = None
-            if paper_data.get('externalIds', {}).get('ArXiv'):
-                arxiv_id = paper_data['externalIds']['ArXiv']
-                arxiv_url = f"https://arxiv.org/pdf/{arxiv_id}.pdf"
-                async with session.get(arxiv_url) as response:
-                    if response.status == 200:
-                        return arxiv_url
-
-            # unpaywall
-            if paper_data.get('externalIds', {}).get('DOI'):
-                doi = paper_data['externalIds']['DOI']
-                unpaywall_url = f"https://api.unpaywall.org/v2/{doi}?email=test@example.com"
-                async with session.get(unpaywall_url) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if data.get('best_oa_location', {}).get('url_for_pdf'):
-                            return data['best_oa_location']['url_for_pdf']
-
-            # CORE API
-            if paper_data.get('externalIds', {}).get('DOI'):
-                core_url = f"https://api.core.ac.uk/v3/search/works?q=doi:{doi}"
-                headers = {"Authorization": "Bearer your_core_api_key"}  # Optional
-                async with session.get(core_url, headers=headers) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        if data.get('results') and data['results'][0].get('downloadUrl'):
-                            return data['results'][0]['downloadUrl']
+            await self.wait_for_rate_limit(pdf_url)
+            async with session.head(pdf_url, allow_redirects=True, timeout=self.probe_timeout) as response:
+                if response.status == 200:
+                    return self.is_pdf_response(response)
+                if response.status in self.not_found_statuses:
+                    self.logger.info(f"PDF probe failed for {pdf_url} (Status: {response.status})")
+                    return False
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.logger.debug(f"HEAD request failed for {pdf_url}: {str(e)}")
 
+        # some servers reject or fail on HEAD, ask for the first byte instead
+        response = await self._request_with_retries(session, 'GET', pdf_url, headers={'Range': 'bytes=0-0'},
+                                                    timeout=self.probe_timeout)
+        async with response:
+            if response.status in (200, 206):
+                return self.is_pdf_response(response)
+            if response.status in self.not_found_statuses:
+                return False
+            self.logger.info(f"PDF probe inconclusive for {pdf_url} (Status: {response.status})")
             return None
-        except Exception as e:
-            self.logger.debug(f"Error checking alternative sources: {str(e)}")
-            return None
+
+    async def _try_arxiv(self, arxiv_id: str, session: aiohttp.ClientSession) -> Optional[str]:
+        """Return the arXiv PDF URL if it exists"""
+        arxiv_url = f"https://arxiv.org/pdf/{arxiv_id}.pdf"
+        result = await self.probe_pdf(arxiv_url, session)
+        if result is None:
+            raise LookupInconclusive(f"arXiv probe for {arxiv_id} was inconclusive")
+        return arxiv_url if result else None
+
+    async def _try_unpaywall(self, doi: str, session: aiohttp.ClientSession) -> Optional[str]:
+        """Return the best open access PDF URL known to Unpaywall"""
+        unpaywall_url = f"https://api.unpaywall.org/v2/{doi}?email=test@example.com"
+        response = await self._request_with_retries(session, 'GET', unpaywall_url)
+        async with response:
+            if not self._response_ok(response, f"Unpaywall lookup for {doi}", logging.INFO):
+                if response.status in self.not_found_statuses:
+                    return None
+                raise LookupInconclusive(f"Unpaywall lookup for {doi} failed with status {response.status}")
+            data = orjson.loads(await response.read())
+            if (data.get('best_oa_location') or {}).get('url_for_pdf'):
+                return data['best_oa_location']['url_for_pdf']
+        return None
+
+    async def _try_core(self, doi: str, session: aiohttp.ClientSession) -> Optional[str]:
+        """Return a download URL from the CORE API"""
+        core_url = f"https://api.core.ac.uk/v3/search/works?q=doi:{doi}"
+        headers = {"Authorization": "Bearer your_core_api_key"}  # Optional
+        response = await self._request_with_retries(session, 'GET', core_url, headers=headers)
+        async with response:
+            if not self._response_ok(response, f"CORE lookup for {doi}", logging.INFO):
+                if response.status in self.not_found_statuses:
+                    return None
+                raise LookupInconclusive(f"CORE lookup for {doi} failed with status {response.status}")
+            data = orjson.loads(await response.read())
+            if data.get('results') and data['results'][0].get('downloadUrl'):
+                return data['results'][0]['downloadUrl']
+        return None
+
+    async def try_alternative_sources(self, paper_data: Dict, session: aiohttp.ClientSession) -> Tuple[Optional[str], bool]:
+        """Try to find PDF from alternative sources, querying them all at once
+
+        Returns the PDF URL, if any, and whether every source gave a definite answer.
+        """
+        external_ids = paper_data.get('externalIds') or {}
+        lookups = []
+        if external_ids.get('ArXiv'):
+            lookups.append(self._try_arxiv(external_ids['ArXiv'], session))
+        if external_ids.get('DOI'):
+            lookups.append(self._try_unpaywall(external_ids['DOI'], session))
+            lookups.append(self._try_core(external_ids['DOI'], session))
+        if not lookups:
+            return None, True
+
+        tasks = [asyncio.ensure_future(lookup) for lookup in lookups]
+        try:
+            # first source to come back with a URL wins
+            conclusive = True
+            for next_done in asyncio.as_completed(tasks):
+                try:
+                    pdf_url = await next_done
+                except Exception as e:
+                    self.logger.debug(f"Error checking alternative sources: {str(e)}")
+                    conclusive = False
+                    continue
+                if pdf_url:
+                    return pdf_url, True
+            return None, conclusive
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     async def download_pdf(self, paper_data: Dict, session: aiohttp.ClientSession) -> bool:
         """Download PDF file from the given paper data"""
         title = paper_data.get('title', 'Unknown Title')
-        
+
         try:
+            # skip papers downloaded by a previous run
+            cached_path = await self.get_cached_pdf(paper_data.get('paperId'))
+            if cached_path:
+                print(f"✅ Already downloaded: {title} -> {os.path.basename(cached_path)}")
+                paper_data['saved_filename'] = os.path.basename(cached_path)
+                return True
+
+            # a previous run already looked for this PDF and found nothing
+            if paper_data.get('paperId') in self.previously_visited:
+                print(f"❌ {title} - No PDF found in a previous run")
+                return False
+
             # semantic scholar's open access
             pdf_url = None
             if paper_data.get('openAccessPdf'):
@@ -119,120 +465,271 @@ class PaperFetcher:
                 self.logger.info(f"Found open access PDF URL: {pdf_url}")
             
             # if semantic scholar returns error, try other sources
+            conclusive = True
             if not pdf_url:
-                pdf_url = await self.try_alternative_sources(paper_data, session)
+                pdf_url, conclusive = await self.try_alternative_sources(paper_data, session)
                 if pdf_url:
                     self.logger.info(f"Found PDF from alternative source: {pdf_url}")
                 
             if not pdf_url:
                 print(f"❌ {title} - No open access PDF available")
+                # only remember it if no source failed, otherwise a later run should look again
+                if conclusive:
+                    self._no_pdf_found[paper_data.get('paperId')] = time.time()
+                return False
+
+            if not await self.probe_pdf(pdf_url, session):
+                print(f"❌ {title} - URL does not serve a PDF: {pdf_url}")
                 return False
 
             self.logger.info(f"Attempting to download from: {pdf_url}")
-            
-            async with session.get(pdf_url) as response:
-                if response.status == 200:
-                    # get filename
-                    filename = self.extract_filename_from_response(response, paper_data)
-                    filepath = os.path.join(self.output_dir, filename)
-                    
-                    # adjust filename if it is already taken
-                    base, ext = os.path.splitext(filepath)
-                    counter = 1
-                    while os.path.exists(filepath):
+            timeout = aiohttp.ClientTimeout(total=None, sock_read=30)
+            # PDFs are already compressed, so ask for the raw bytes and skip decompression
+            headers = {'Accept-Encoding': 'identity'}
+            response = await self._request_with_retries(session, 'GET', pdf_url, timeout=timeout, headers=headers,
+                                                        read_until_eof=True)
+            async with response:
+                if not self._response_ok(response, f"Downloading {pdf_url}", logging.INFO):
+                    print(f"❌ {title} - Failed to download PDF (Status: {response.status})")
+                    return False
+
+                # skip anything that is clearly not a PDF before reading the body
+                if not self.is_pdf_response(response):
+                    print(f"❌ {title} - Not a PDF (Content-Type: {response.headers.get('Content-Type')})")
+                    return False
+                if response.content_length is not None and response.content_length > self.max_pdf_size:
+                    print(f"❌ {title} - PDF too large ({response.content_length} bytes)")
+                    return False
+
+                # get filename
+                filename = self.extract_filename_from_response(response, paper_data)
+                filepath = os.path.join(self.output_dir, filename)
+                
+                # create the file exclusively, adjusting the filename if it is already taken
+                base, ext = os.path.splitext(filepath)
+                counter = 1
+                while True:
+                    try:
+                        f = await aiofiles.open(filepath, 'xb')
+                        break
+                    except FileExistsError:
                         filepath = f"{base}_{counter}{ext}"
                         counter += 1
                         self.logger.info(f"File exists, trying new name: {os.path.basename(filepath)}")
 
-                    self.logger.info(f"Saving to: {filepath}")
-                    async with aiofiles.open(filepath, 'wb') as f:
-                        await f.write(await response.read())
-                    print(f"✅ Downloaded: {title} -> {os.path.basename(filepath)}")
-                    
-                    # add file name to paper metadata
-                    paper_data['saved_filename'] = os.path.basename(filepath)
-                    return True
-                print(f"❌ {title} - Failed to download PDF (Status: {response.status})")
-                return False
+                self.logger.info(f"Saving to: {filepath}")
+                # Content-Length may be missing, so enforce the size limit while streaming too
+                written = 0
+                completed = False
+                try:
+                    async for chunk in response.content.iter_chunked(self.chunk_size):
+                        written += len(chunk)
+                        if written > self.max_pdf_size:
+                            break
+                        await f.write(chunk)
+                    else:
+                        completed = True
+                finally:
+                    await f.close()
+                    # don't leave a truncated PDF behind if the download failed or was cancelled
+                    if not completed:
+                        await aiofiles.os.remove(filepath)
+                if written > self.max_pdf_size:
+                    print(f"❌ {title} - PDF too large (over {self.max_pdf_size} bytes)")
+                    return False
+                print(f"✅ Downloaded: {title} -> {os.path.basename(filepath)}")
+                
+                # add file name to paper metadata
+                paper_data['saved_filename'] = os.path.basename(filepath)
+                await self.cache_pdf(paper_data.get('paperId'), filepath)
+                return True
         except Exception as e:
             print(f"❌ {title} - Error downloading PDF: {str(e)}")
             self.logger.error(f"Download error details: {str(e)}", exc_info=True)
             return False
 
-    async def fetch_paper_details(self, paper_id: str, session: aiohttp.ClientSession, retries=3) -> Dict:
+    async def fetch_paper_details(self, paper_id: str, session: aiohttp.ClientSession) -> Dict:
         """Fetch paper metadata from Semantic Scholar API with retries"""
+        cached = await self.get_cached_paper(paper_id)
+        if cached:
+            self.logger.info(f"Using cached metadata for paper: {cached.get('title', 'Unknown')}")
+            return cached
+
         async with self.rate_limit:
-            for attempt in range(retries):
-                try:
-                    await self.wait_for_rate_limit()
-                    params = {
-                        'fields': 'title,year,authors,citations,references,externalIds,url,openAccessPdf'
-                    }
-                    async with session.get(f"{self.base_url}{paper_id}", params=params, headers=self.headers) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            self.logger.info(f"Successfully fetched metadata for paper: {data.get('title', 'Unknown')}")
-                            return data
-                        elif response.status == 429:
-                            wait_time = 5 * (attempt + 1)  
-                            self.logger.warning(f"Rate limit hit, waiting {wait_time} seconds...")
-                            await asyncio.sleep(wait_time)
-                            continue
-                        else:
-                            self.logger.error(f"Failed to fetch paper {paper_id}: Status {response.status}")
-                            return None
-                except Exception as e:
-                    self.logger.error(f"Error fetching paper {paper_id}: {str(e)}")
-                    if attempt < retries - 1:
-                        await asyncio.sleep(1)
+            try:
+                params = {
+                    'fields': self.paper_fields
+                }
+                response = await self._request_with_retries(session, 'GET', f"{self.base_url}{paper_id}",
+                                                            params=params, headers=self.headers)
+                async with response:
+                    if not self._response_ok(response, f"Fetching paper {paper_id}"):
+                        return None
+                    data = orjson.loads(await response.read())
+                    self.logger.info(f"Successfully fetched metadata for paper: {data.get('title', 'Unknown')}")
+                    await self.cache_papers({paper_id: data})
+                    return data
+            except Exception as e:
+                self.logger.error(f"Error fetching paper {paper_id}: {str(e)}")
+                return None
+
+    async def _fetch_batch(self, paper_ids: List[str], session: aiohttp.ClientSession) -> Optional[List[Dict]]:
+        """Send one batch request, returning None if it failed"""
+        async with self.rate_limit:
+            try:
+                params = {
+                    'fields': self.paper_fields
+                }
+                response = await self._request_with_retries(session, 'POST', f"{self.base_url}batch",
+                                                            params=params, json={'ids': paper_ids}, headers=self.headers)
+                async with response:
+                    if not self._response_ok(response, f"Fetching batch of {len(paper_ids)} papers"):
+                        return None
+                    data = orjson.loads(await response.read())
+            except Exception as e:
+                self.logger.error(f"Error fetching batch of {len(paper_ids)} papers: {str(e)}")
+                return None
+
+        # unknown ids come back as null entries
+        fetched = [paper for paper in data if paper]
+        await self.cache_papers({paper['paperId']: paper for paper in fetched})
+        self.logger.info(f"Successfully fetched metadata for {len(fetched)}/{len(paper_ids)} papers")
+        return fetched
+
+    async def fetch_paper_details_batch(self, paper_ids: List[str], session: aiohttp.ClientSession) -> List[Dict]:
+        """Fetch metadata for many papers at once using the Semantic Scholar batch endpoint"""
+        cached = await self.get_cached_papers(paper_ids)
+        papers = list(cached.values())
+        missing = [paper_id for paper_id in paper_ids if paper_id not in cached]
+        if papers:
+            self.logger.info(f"Using cached metadata for {len(papers)} papers")
+
+        chunks = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        while chunks:
+            chunk = chunks.pop()
+            if len(chunk) == 1:
+                paper_data = await self.fetch_paper_details(chunk[0], session)
+                if paper_data:
+                    papers.append(paper_data)
+                continue
+
+            fetched = await self._fetch_batch(chunk, session)
+            if fetched is not None:
+                papers.extend(fetched)
+            else:
+                # the batch endpoint rejects requests whose papers have too many citations in total,
+                # so retry the two halves separately
+                middle = len(chunk) // 2
+                self.logger.warning(f"Splitting failed batch of {len(chunk)} papers")
+                chunks.extend([chunk[:middle], chunk[middle:]])
+        return papers
+
+    async def _metadata_worker(self, work_queue: asyncio.Queue, download_queue: asyncio.Queue, session: aiohttp.ClientSession):
+        """Fetch metadata for queued paper ids and queue their connected papers"""
+        while True:
+            items = [await work_queue.get()]
+            # batch whatever else is already waiting into the same request
+            while len(items) < self.batch_size and not work_queue.empty():
+                items.append(work_queue.get_nowait())
+            try:
+                depths = {}
+                for paper_id, depth in items:
+                    if paper_id not in self.visited_papers and depth >= 0:
+                        self.visited_papers.add(paper_id)
+                        depths[paper_id] = depth
+                if not depths:
+                    continue
+
+                if len(depths) == 1:
+                    paper_data = await self.fetch_paper_details(next(iter(depths)), session)
+                    papers = [paper_data] if paper_data else []
+                else:
+                    papers = await self.fetch_paper_details_batch(list(depths), session)
+
+                # ids given in another form (e.g. DOI:...) come back under their canonical paperId
+                default_depth = max(depths.values())
+                for paper_data in papers:
+                    depth = depths.get(paper_data.get('paperId'), default_depth)
+                    self.visited_papers.add(paper_data.get('paperId'))
+                    await download_queue.put(paper_data)
+                    if depth == 0:
                         continue
-                    return None
-            return None
+
+                    # queue the references and citations of this paper
+                    connected_papers = []
+                    if paper_data.get('references'):
+                        connected_papers.extend(paper_data['references'])
+                    if paper_data.get('citations'):
+                        connected_papers.extend(paper_data['citations'])
+
+                    # skip papers already seen or queued rather than queueing no-op work
+                    new_papers = {}
+                    for paper in connected_papers:
+                        new_id = paper.get('paperId')
+                        if new_id and new_id not in self.visited_papers and new_id not in self._scheduled:
+                            new_papers.setdefault(new_id, paper)
+
+                    # follow only the most recent new papers to keep the graph from exploding
+                    new_ids = sorted(new_papers, key=lambda pid: new_papers[pid].get('year') or 0, reverse=True)
+                    new_ids = new_ids[:self.max_children]
+
+                    if new_ids:
+                        print(f"\nProcessing {len(new_ids)} papers connected to: {paper_data.get('title')}")
+
+                    self._scheduled.update(new_ids)
+                    for new_id in new_ids:
+                        work_queue.put_nowait((new_id, depth - 1))
+            except Exception as e:
+                self.logger.error(f"Error processing papers: {str(e)}", exc_info=True)
+            finally:
+                for _ in items:
+                    work_queue.task_done()
+
+    async def _download_worker(self, download_queue: asyncio.Queue, results: List[Dict], session: aiohttp.ClientSession):
+        """Download queued papers and record the ones that succeed"""
+        while True:
+            paper_data = await download_queue.get()
+            try:
+                if await self.download_pdf(paper_data, session):
+                    paper_id = paper_data.get('paperId')
+                    results.append({
+                        'id': paper_id,
+                        'title': paper_data.get('title', 'Unknown'),
+                        'authors': [a.get('name', '') for a in paper_data.get('authors', [])],
+                        'year': paper_data.get('year'),
+                        'url': paper_data.get('url'),
+                        'filename': paper_data.get('saved_filename'),
+                        'pdf_path': os.path.join(self.output_dir, paper_data.get('saved_filename', f"{paper_id}.pdf"))
+                    })
+                    # save as we go so an interrupted run keeps what it downloaded
+                    await self.save_metadata(results, force=False)
+            except Exception as e:
+                self.logger.error(f"Error downloading paper {paper_data.get('paperId')}: {str(e)}", exc_info=True)
+            finally:
+                download_queue.task_done()
 
     async def process_paper(self, paper_id: str, depth: int, session: aiohttp.ClientSession) -> List[Dict]:
-        """Process a paper and its connected papers recursively"""
-        if paper_id in self.visited_papers or depth < 0:
-            return []
-            
-        self.visited_papers.add(paper_id)
-        paper_data = await self.fetch_paper_details(paper_id, session)
-        
-        if not paper_data:
-            return []
-            
+        """Process a paper and its connected papers breadth first with a bounded pool of workers"""
         results = []
-        # proccess the chosen paper
-        if await self.download_pdf(paper_data, session):
-            results.append({
-                'id': paper_id,
-                'title': paper_data.get('title', 'Unknown'),
-                'authors': [a.get('name', '') for a in paper_data.get('authors', [])],
-                'year': paper_data.get('year'),
-                'url': paper_data.get('url'),
-                'filename': paper_data.get('saved_filename'),
-                'pdf_path': os.path.join(self.output_dir, paper_data.get('saved_filename', f"{paper_id}.pdf"))
-            })
-
-        # proccess the references papers inside chosen paper
-        connected_papers = []
-        if paper_data.get('references'):
-            connected_papers.extend(paper_data['references'])
-        if paper_data.get('citations'):
-            connected_papers.extend(paper_data['citations'])
-
-        if connected_papers:
-            print(f"\nProcessing {len(connected_papers)} papers connected to: {paper_data.get('title')}")
-        
-        tasks = []
-        for paper in connected_papers:
-            if paper.get('paperId'):
-                tasks.append(self.process_paper(paper['paperId'], depth - 1, session))
-        
-        if tasks:
-            child_results = await asyncio.gather(*tasks)
-            for result in child_results:
-                results.extend(result)
-                
+        work_queue = asyncio.Queue()
+        download_queue = asyncio.Queue(maxsize=self.num_workers * 2)
+        work_queue.put_nowait((paper_id, depth))
+        self._scheduled.add(paper_id)
+
+        workers = [asyncio.create_task(self._metadata_worker(work_queue, download_queue, session))
+                   for _ in range(self.num_metadata_workers)]
+        workers += [asyncio.create_task(self._download_worker(download_queue, results, session))
+                    for _ in range(self.num_workers)]
+        try:
+            await work_queue.join()
+            await download_queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            await self.save_metadata(results)
+            await self.save_visited()
+
         return results
 
     async def search_papers(self, query: str, session: aiohttp.ClientSession, limit: int = 5) -> List[Dict]:
@@ -244,54 +741,40 @@ class PaperFetcher:
             "fields": "title,authors,year,abstract,externalIds,url,paperId"
         }
 
-        max_retries = 3
-        retry_delay = 5 
-        
-        for attempt in range(max_retries):
-            async with self.rate_limit:
-                await self.wait_for_rate_limit()
-                try:
-                    async with session.get(search_url, params=params, headers=self.headers) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            return data.get('data', [])
-                        elif response.status == 429:  # this is the rate limit error code
-                            if attempt < max_retries - 1:
-                                self.logger.warning(f"Rate limit hit, waiting {retry_delay} seconds...")
-                                await asyncio.sleep(retry_delay)
-                                retry_delay *= 2  
-                                continue
-                        self.logger.error(f"Search failed with status {response.status}")
+        async with self.rate_limit:
+            try:
+                response = await self._request_with_retries(session, 'GET', search_url, params=params, headers=self.headers)
+                async with response:
+                    if not self._response_ok(response, "Search"):
                         return []
-                except Exception as e:
-                    self.logger.error(f"Error during search: {e}")
-                    if attempt < max_retries - 1:
-                        await asyncio.sleep(retry_delay)
-                        continue
-                    return []
-        return []
+                    data = orjson.loads(await response.read())
+                    return data.get('data', [])
+            except Exception as e:
+                self.logger.error(f"Error during search: {e}")
+                return []
 
     async def fetch_connected_papers(self, paper_id: str, depth: int = 1):
         """Main method to fetch and download connected papers"""
-        os.makedirs(self.output_dir, exist_ok=True)
+        await asyncio.to_thread(os.makedirs, self.output_dir, exist_ok=True)
         
         print(f"\n📚 Starting paper download with depth {depth}")
         print("=" * 80)
         
-        async with aiohttp.ClientSession() as session:
+        # close the session and cache afterwards unless the caller is managing them with `async with`
+        owns_resources = self._session is None or self._session.closed
+        try:
+            session = await self._get_session()
             results = await self.process_paper(paper_id, depth, session)
-        
-        # save all the metadata
-        metadata_file = os.path.join(self.output_dir, 'papers_metadata.json')
-        with open(metadata_file, 'w') as f:
-            json.dump(results, f, indent=2)
+        finally:
+            if owns_resources:
+                await self.aclose()
         
         print("\n" + "=" * 80)
         print(f"📊 Summary:")
         print(f"   - Processed {len(self.visited_papers)} papers in total")
         print(f"   - Successfully downloaded {len(results)} PDFs")
         print(f"   - PDFs saved to: {self.output_dir}/")
-        print(f"   - Metadata saved to: {metadata_file}")
+        print(f"   - Metadata saved to: {self.metadata_file}")
         print("=" * 80)
         
         return results
@@ -303,6 +786,7 @@ async def main():
     parser.add_argument('--depth', type=int, default=0, help='How many levels of references to download')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose logging')
     parser.add_argument('--api-key', type=str, help='Semantic Scholar API key')
+    parser.add_argument('--max-children', type=int, default=50, help='Maximum number of connected papers to follow per paper')
     args = parser.parse_args()
 
     if args.verbose:
@@ -313,10 +797,10 @@ async def main():
         parser.error("Either --search or --paper-id must be provided")
 
     output_dir = "papers"
-    os.makedirs(output_dir, exist_ok=True)
+    await asyncio.to_thread(os.makedirs, output_dir, exist_ok=True)
 
-    fetcher = PaperFetcher(output_dir, args.api_key)
-    async with aiohttp.ClientSession() as session:
+    async with PaperFetcher(output_dir, args.api_key, args.max_children) as fetcher:
+        session = fetcher.session
         if args.search:
             papers = await fetcher.search_papers(args.search, session)
             if not papers:
@@ -349,4 +833,7 @@ async def main():
         await fetcher.process_paper(args.paper_id, args.depth, session)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())